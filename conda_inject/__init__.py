@@ -1,19 +1,34 @@
-from dataclasses import dataclass
-import hashlib
+from collections import Counter
+from dataclasses import dataclass, field
+import importlib
 import json
 import os
 from pathlib import Path
 import re
+import shutil
 import sys
 from enum import Enum
+from functools import lru_cache
 import subprocess as sp
-import tempfile
 from typing import Dict, List, Optional, Set
 
-import yaml
-
 package_spec_pattern = re.compile(r"(?P<package>[^=><\s]+)(\s*)(?P<constraint>.+)?")
 
+# upper bound for the number of concurrent solver subprocesses in inject_envs
+_MAX_PARALLEL_ENV_CREATIONS = 4
+
+# number of active injections per injected sys.path and PATH entry, such that
+# overlapping injections of the same env share their entries
+_syspath_refcounts: Counter = Counter()
+_path_refcounts: Counter = Counter()
+# entries appended by conda-inject (as opposed to those already present before),
+# which are removed again once their last injection is deactivated
+_appended_syspath_entries: Set[str] = set()
+_appended_path_entries: Set[str] = set()
+
+# slots are only supported by dataclasses from Python 3.10 on
+_dataclass_options = {"slots": True} if sys.version_info >= (3, 10) else {}
+
 
 class PackageManager(Enum):
     """Enum of supported package managers."""
@@ -23,7 +38,34 @@ class PackageManager(Enum):
     MICROMAMBA = "micromamba"
 
 
-@dataclass
+@lru_cache(maxsize=None)
+def _detect_fastest_package_manager() -> PackageManager:
+    """Return the fastest package manager available in PATH.
+
+    Preference order is micromamba, mamba, conda. The result is cached for
+    the lifetime of the process.
+    """
+    for package_manager in (
+        PackageManager.MICROMAMBA,
+        PackageManager.MAMBA,
+        PackageManager.CONDA,
+    ):
+        if shutil.which(package_manager.value) is not None:
+            return package_manager
+    # nothing found, keep the previous default and let the subprocess call
+    # fail with a meaningful error
+    return PackageManager.MAMBA
+
+
+def _resolve_package_manager(
+    package_manager: Optional[PackageManager],
+) -> PackageManager:
+    if package_manager is None:
+        return _detect_fastest_package_manager()
+    return package_manager
+
+
+@dataclass(**_dataclass_options)
 class Environment:
     path: str
 
@@ -32,70 +74,166 @@ class Environment:
         return os.path.basename(self.path)
 
 
-@dataclass
+@dataclass(**_dataclass_options)
 class InjectedEnvironment:
     name: str
     package_manager: PackageManager
     env: Optional[Environment] = None
+    _syspath_injection: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _path_injection: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _injected_syspath_entry: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _injected_path_entry: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
-    def __post_init__(self):
-        envs = _get_envs(self.package_manager)
-        self.env = envs[self.name]
-        self._inject_path()
+    def activate(self) -> "InjectedEnvironment":
+        """Inject the environment into the current process.
+
+        Looks up the environment unless it has been given explicitly. Calling
+        this on an already active environment has no effect.
+        """
+        if self.env is None:
+            self.env = _lookup_env(self.name, self.package_manager)
+            if self.env is None:
+                raise KeyError(f"Environment {self.name} does not exist.")
+        if self._path_injection is None:
+            # the injected paths are invariant, hence compute them once
+            self._syspath_injection = (
+                f"{self.env.path}/lib/"
+                f"python{sys.version_info.major}.{sys.version_info.minor}/"
+                "site-packages"
+            )
+            self._path_injection = f"{self.env.path}/bin"
+        if self._injected_path_entry is None:
+            self._inject_path()
+        return self
 
     def remove(self):
         """Remove the environment."""
-        sp.run(
-            [self.package_manager.value, "env", "remove", "-n", self.name, "-y"],
-            check=True,
-            stdout=sp.PIPE,
-            stderr=sp.STDOUT,
+        _run_package_manager(
+            [self.package_manager.value, "env", "remove", "-n", self.name, "-y"]
         )
+        _get_envs.cache_clear()
+        _uncache_env(self.name)
         self.deactivate()
 
     def deactivate(self):
-        injection = self._get_syspath_injection()
-        try:
-            sys.path.remove(injection)
-        except ValueError:
-            # nothing to remove
-            pass
-        os.environ["PATH"] = os.environ["PATH"].replace(self._get_path_injection(), "")
+        if self._injected_syspath_entry is not None:
+            _release(
+                sys.path,
+                self._injected_syspath_entry,
+                _syspath_refcounts,
+                _appended_syspath_entries,
+            )
+            self._injected_syspath_entry = None
+        if self._injected_path_entry is not None:
+            entries = _get_path_entries()
+            if _release(
+                entries,
+                self._injected_path_entry,
+                _path_refcounts,
+                _appended_path_entries,
+            ):
+                os.environ["PATH"] = os.pathsep.join(entries)
+            self._injected_path_entry = None
 
     def __enter__(self):
-        return self
+        return self.activate()
 
     def __exit__(self, *args):
         self.deactivate()
 
     def _inject_path(self):
-        # manipulate python path
-        sys.path.append(self._get_syspath_injection())
+        # manipulate python path, avoiding duplicate entries that would slow
+        # down every subsequent import
+        self._injected_syspath_entry = self._get_syspath_injection()
+        if _acquire(
+            sys.path,
+            self._injected_syspath_entry,
+            _syspath_refcounts,
+            _appended_syspath_entries,
+        ):
+            importlib.invalidate_caches()
         # manipulate PATH
-        os.environ["PATH"] = f"{os.environ['PATH']}{self._get_path_injection()}"
+        self._injected_path_entry = self._get_path_injection()
+        entries = _get_path_entries()
+        if _acquire(
+            entries,
+            self._injected_path_entry,
+            _path_refcounts,
+            _appended_path_entries,
+        ):
+            os.environ["PATH"] = os.pathsep.join(entries)
 
     def _get_path_injection(self):
-        return f":{self.env.path}/bin"
+        return self._path_injection
 
     def _get_syspath_injection(self):
-        return (
-            f"{self.env.path}/lib/"
-            f"python{sys.version_info.major}.{sys.version_info.minor}/"
-            "site-packages"
-        )
+        return self._syspath_injection
+
+
+def _acquire(
+    entries: List[str], entry: str, refcounts: Counter, appended: Set[str]
+) -> bool:
+    """Register an injection of the given entry, appending it to entries unless
+    already present. Return True if entries has been modified."""
+    refcounts[entry] += 1
+    if entry in entries:
+        return False
+    entries.append(entry)
+    appended.add(entry)
+    return True
+
+
+def _release(
+    entries: List[str], entry: str, refcounts: Counter, appended: Set[str]
+) -> bool:
+    """Drop an injection of the given entry, removing it from entries if it was
+    the last one and the entry has been appended by us. Return True if entries
+    has been modified."""
+    refcounts[entry] -= 1
+    if refcounts[entry] > 0:
+        return False
+    del refcounts[entry]
+    if entry not in appended:
+        return False
+    appended.discard(entry)
+    _remove_last(entries, entry)
+    return True
+
+
+def _remove_last(entries: List[str], entry: str):
+    # remove the last occurrence, which is the one we appended
+    for i in range(len(entries) - 1, -1, -1):
+        if entries[i] == entry:
+            del entries[i]
+            return
+
+
+def _get_path_entries() -> List[str]:
+    path = os.environ.get("PATH")
+    return path.split(os.pathsep) if path else []
 
 
 def inject_packages(
     channels: List[str],
     packages: List[str],
     with_constraints: Optional[List[str]] = None,
-    package_manager: PackageManager = PackageManager.MAMBA,
+    package_manager: Optional[PackageManager] = None,
 ) -> InjectedEnvironment:
     """Inject conda packages into the current environment.
 
     Args:
         channels: List of channels to search for packages.
         packages: List of packages to install.
+        package_manager: Package manager to use. If None, the fastest available
+            one (micromamba > mamba > conda) is used.
     """
     env = {
         "channels": channels,
@@ -110,7 +248,7 @@ def inject_packages(
 def inject_env(
     env: Dict[str, List[str]],
     with_constraints: Optional[List[str]] = None,
-    package_manager: PackageManager = PackageManager.MAMBA,
+    package_manager: Optional[PackageManager] = None,
 ) -> InjectedEnvironment:
     """Inject conda packages into the current environment.
 
@@ -118,28 +256,99 @@ def inject_env(
         env: Environment to inject, given as dict with the keys `channels` and
              `dependencies`. The expected values are the same as for conda
              `environment.yml` files.
+        package_manager: Package manager to use. If None, the fastest available
+            one (micromamba > mamba > conda) is used.
     """
+    package_manager = _resolve_package_manager(package_manager)
     invalid_packages = _get_invalid_packages(with_constraints)
-    _check_env(env, invalid_packages=invalid_packages)
-    _insert_constraints(env, with_constraints)
-    env_name = _get_env_name(env)
+    env_name = _prepare_env(env, with_constraints, invalid_packages)
+
+    existing = _lookup_env(env_name, package_manager)
+    if existing is None:
+        _create_env_from_dict(env, env_name, package_manager=package_manager)
 
-    envs = _get_envs(package_manager)
+    return InjectedEnvironment(
+        name=env_name, package_manager=package_manager, env=existing
+    ).activate()
 
-    if env_name not in envs:
-        with tempfile.NamedTemporaryFile(suffix=".conda.yaml", mode="w") as tmp:
-            yaml.dump(env, tmp)
-            tmp.flush()
-            _create_env(Path(tmp.name), env_name, package_manager=package_manager)
 
-    return InjectedEnvironment(name=env_name, package_manager=package_manager)
+def inject_envs(
+    envs: List[Dict[str, List[str]]],
+    with_constraints: Optional[List[str]] = None,
+    package_manager: Optional[PackageManager] = None,
+) -> List[InjectedEnvironment]:
+    """Inject multiple conda environments into the current environment.
+
+    Existing environments are looked up with a single query to the package
+    manager, missing ones are created in parallel.
+
+    Args:
+        envs: Environments to inject, each given as dict with the keys `channels`
+              and `dependencies` (see `inject_env`).
+        package_manager: Package manager to use. If None, the fastest available
+            one (micromamba > mamba > conda) is used.
+    """
+    package_manager = _resolve_package_manager(package_manager)
+    invalid_packages = _get_invalid_packages(with_constraints)
+    env_names = [_prepare_env(env, with_constraints, invalid_packages) for env in envs]
+
+    cached = _read_env_cache()
+    found = {}
+    for env_name in env_names:
+        existing = _get_cached_env(env_name, cached)
+        if existing is not None:
+            found[env_name] = existing
+    missing = {
+        env_name: env for env_name, env in zip(env_names, envs) if env_name not in found
+    }
+    if missing:
+        for env_name in missing:
+            existing = _get_listed_env(env_name, package_manager)
+            if existing is not None:
+                found[env_name] = existing
+                _cache_env(existing)
+        missing = {
+            env_name: env for env_name, env in missing.items() if env_name not in found
+        }
+    if missing:
+        from concurrent.futures import ThreadPoolExecutor
+
+        # env creation is bound by the solver subprocess, hence threads suffice
+        if package_manager == PackageManager.CONDA:
+            # conda is not safe to run concurrently on a shared package cache
+            max_workers = 1
+        else:
+            max_workers = min(len(missing), _MAX_PARALLEL_ENV_CREATIONS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _create_env_from_dict,
+                    env,
+                    env_name,
+                    package_manager=package_manager,
+                )
+                for env_name, env in missing.items()
+            ]
+            for future in futures:
+                future.result()
+
+    return [
+        InjectedEnvironment(
+            name=env_name,
+            package_manager=package_manager,
+            env=found.get(env_name),
+        ).activate()
+        for env_name in env_names
+    ]
 
 
 def inject_env_file(
     env_file: Path,
     with_constraints: Optional[List[str]] = None,
-    package_manager: PackageManager = PackageManager.MAMBA,
+    package_manager: Optional[PackageManager] = None,
 ):
+    import yaml
+
     with open(env_file) as f:
         env = yaml.load(f, Loader=yaml.FullLoader)
     return inject_env(
@@ -147,11 +356,63 @@ def inject_env_file(
     )
 
 
+def _prepare_env(
+    env: Dict[str, List[str]],
+    with_constraints: Optional[List[str]],
+    invalid_packages: Set[str],
+) -> str:
+    _check_env(env, invalid_packages=invalid_packages)
+    _insert_constraints(env, with_constraints)
+    return _get_env_name(env)
+
+
+def _create_env_from_dict(
+    env: Dict[str, List[str]],
+    env_name: str,
+    package_manager: PackageManager = PackageManager.MAMBA,
+):
+    import tempfile
+
+    with tempfile.NamedTemporaryFile(
+        suffix=".conda.yaml", mode="w", encoding="utf-8"
+    ) as tmp:
+        _dump_env(env, tmp)
+        tmp.flush()
+        _create_env(Path(tmp.name), env_name, package_manager=package_manager)
+
+
+def _dump_env(env: Dict[str, List[str]], f):
+    """Write the given env as YAML.
+
+    Envs consisting of plain channel and dependency lists (the common case) are
+    written directly, anything else (e.g. pip sections) is handled by PyYAML.
+    """
+    if set(env) == {"channels", "dependencies"} and all(
+        isinstance(env[key], list) and all(isinstance(item, str) for item in env[key])
+        for key in env
+    ):
+        for key in ("channels", "dependencies"):
+            f.write(f"{key}:\n" if env[key] else f"{key}: []\n")
+            for item in env[key]:
+                # JSON strings are valid double-quoted YAML scalars (keep
+                # non-ASCII characters as is, YAML does not understand the
+                # surrogate pair escapes JSON uses outside of the BMP)
+                f.write(f"  - {json.dumps(item, ensure_ascii=False)}\n")
+    else:
+        import yaml
+
+        yaml.dump(env, f)
+
+
 def _create_env(
     env_file: Path,
     env_name: str,
     package_manager: PackageManager = PackageManager.MAMBA,
 ):
+    if _get_cached_env(env_name) is not None:
+        # The environment has been created in the meantime (e.g. by a concurrent
+        # process). Names are content-addressed, so there is nothing left to do.
+        return
     cmd = [
         package_manager.value,
         "env",
@@ -160,8 +421,31 @@ def _create_env(
         env_name,
         "-f",
         env_file,
+        "--quiet",
     ]
-    sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sp.STDOUT)
+    # avoid prompts, update checks and banners in the solver subprocess
+    env = {
+        **os.environ,
+        "CONDA_ALWAYS_YES": "true",
+        # micromamba only reads MAMBA_ prefixed settings
+        "MAMBA_ALWAYS_YES": "true",
+        "CONDA_AUTO_UPDATE_CONDA": "false",
+        "MAMBA_NO_BANNER": "1",
+    }
+    try:
+        _run_package_manager(cmd, env=env)
+    finally:
+        _get_envs.cache_clear()
+
+
+def _run_package_manager(cmd: list, env: Optional[Dict[str, str]] = None):
+    if os.environ.get("CONDA_INJECT_DEBUG"):
+        # show the full output of the package manager
+        sp.run(cmd, check=True, env=env)
+    else:
+        # Only keep stderr (carried by CalledProcessError on failure), the
+        # potentially verbose progress output on stdout is not needed.
+        sp.run(cmd, check=True, stdout=sp.DEVNULL, stderr=sp.PIPE, env=env)
 
 
 def _insert_constraints(env: Dict[str, List[str]], constraints: Optional[List[str]]):
@@ -174,24 +458,134 @@ def _insert_constraints(env: Dict[str, List[str]], constraints: Optional[List[st
 
 
 def _get_env_name(env: Dict[str, List[str]]) -> str:
+    import hashlib
+
     checksum = hashlib.sha256()
-    checksum.update(json.dumps(env).encode("utf-8"))
-    env_checksum = checksum.hexdigest()
+    # sort keys so that equivalent envs map to the same name
+    checksum.update(json.dumps(env, sort_keys=True).encode("utf-8"))
+    # 64 bits are plenty to distinguish the envs of a single installation
+    env_checksum = checksum.hexdigest()[:16]
     return f"conda-inject-{env_checksum}_"
 
 
-def _get_envs(package_manager: PackageManager) -> Dict[str, str]:
-    envs = json.loads(
-        sp.run(
-            [package_manager.value, "env", "list", "--json"],
-            check=True,
-            stdout=sp.PIPE,
-            stderr=sp.STDOUT,
-        ).stdout.decode()
-    )["envs"]
+@lru_cache(maxsize=4)
+def _get_envs(package_manager: PackageManager) -> Dict[str, Environment]:
+    cmd = [package_manager.value, "env", "list", "--json"]
+    # parse directly from the pipe instead of buffering the whole output
+    with sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL) as proc:
+        try:
+            envs = json.load(proc.stdout)["envs"]
+        except ValueError:
+            if proc.wait() != 0:
+                raise sp.CalledProcessError(proc.returncode, cmd)
+            raise
+    if proc.returncode != 0:
+        raise sp.CalledProcessError(proc.returncode, cmd)
     return {env.name: env for env in map(Environment, envs)}
 
 
+def _get_env_cache_path() -> Optional[Path]:
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        try:
+            cache_home = Path.home() / ".cache"
+        except RuntimeError:
+            # no home directory (e.g. in containers), disable the cache
+            return None
+    return Path(cache_home) / "conda-inject" / "envs.json"
+
+
+def _read_env_cache() -> Dict[str, str]:
+    path = _get_env_cache_path()
+    if path is None:
+        return {}
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write_env_cache(cache: Dict[str, str]):
+    import tempfile
+
+    path = _get_env_cache_path()
+    if path is None:
+        return
+    tmp_name = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so that readers never see partial data
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, suffix=".tmp", delete=False
+        ) as tmp:
+            tmp_name = tmp.name
+            json.dump(cache, tmp)
+        os.replace(tmp_name, path)
+        tmp_name = None
+    except OSError:
+        # the cache is only an optimization, ignore failures
+        pass
+    finally:
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+
+
+def _get_cached_env(
+    env_name: str, cache: Optional[Dict[str, str]] = None
+) -> Optional[Environment]:
+    if cache is None:
+        cache = _read_env_cache()
+    path = cache.get(env_name)
+    if isinstance(path, str) and os.path.isdir(path):
+        return Environment(path)
+    return None
+
+
+def _cache_env(env: Environment):
+    cache = _read_env_cache()
+    if cache.get(env.name) != env.path:
+        cache[env.name] = env.path
+        _write_env_cache(cache)
+
+
+def _uncache_env(env_name: str):
+    cache = _read_env_cache()
+    if cache.pop(env_name, None) is not None:
+        _write_env_cache(cache)
+
+
+def _lookup_env(
+    env_name: str, package_manager: PackageManager
+) -> Optional[Environment]:
+    """Find the given environment, avoiding to query the package manager if it
+    is already known from the on-disk cache."""
+    env = _get_cached_env(env_name)
+    if env is None:
+        env = _get_listed_env(env_name, package_manager)
+        if env is not None:
+            _cache_env(env)
+    return env
+
+
+def _get_listed_env(
+    env_name: str, package_manager: PackageManager
+) -> Optional[Environment]:
+    env = _get_envs(package_manager).get(env_name)
+    if env is not None and not os.path.isdir(env.path):
+        # the cached env list is outdated (e.g. the env has been removed by
+        # another process), hence query the package manager again
+        _get_envs.cache_clear()
+        env = _get_envs(package_manager).get(env_name)
+        if env is not None and not os.path.isdir(env.path):
+            env = None
+    return env
+
+
 def _check_env(
     env: dict[str, list], invalid_packages: Optional[Set[str]] = None
 ) -> bool:
@@ -207,11 +601,13 @@ def _check_packages(packages, invalid_packages: Optional[Set[str]] = None):
     """Check if the given package specs are valid."""
     invalid_packages = {"python"} if invalid_packages is None else invalid_packages
 
+    # bind the matcher locally to avoid attribute lookups in the loop
+    match = package_spec_pattern.match
     for package_spec in packages:
         if not isinstance(package_spec, str):
             # ignore e.g. dict rows (coming from combining with pip)
             continue
-        m = package_spec_pattern.match(package_spec)
+        m = match(package_spec)
         if m:
             package_name = m.group("package")
             if package_name in invalid_packages:
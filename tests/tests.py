@@ -1,5 +1,11 @@
+from io import StringIO
+import os
 from pathlib import Path
-from conda_inject import inject_env, inject_packages, inject_env_file
+import sys
+import pytest
+import yaml
+import conda_inject
+from conda_inject import inject_env, inject_envs, inject_packages, inject_env_file
 
 
 def test_env_inject():
@@ -28,3 +34,205 @@ def test_env_inject_with_constraints():
     with inject_env(env, with_constraints=["requests =2.31"]):
         import humanfriendly  # noqa F401
         import requests  # noqa F401
+
+
+def test_invalid_package_spec():
+    env = {"channels": ["conda-forge"], "dependencies": ["python =3.8"]}
+    with pytest.raises(ValueError):
+        inject_env(env)
+    env = {"channels": ["conda-forge"], "dependencies": [">=1.0"]}
+    with pytest.raises(ValueError):
+        inject_env(env)
+
+
+def test_envs_inject():
+    envs = [
+        {"channels": ["conda-forge"], "dependencies": ["humanfriendly =10.0"]},
+        {"channels": ["conda-forge"], "dependencies": ["requests =2.31"]},
+    ]
+    injected = inject_envs(envs)
+    try:
+        import humanfriendly  # noqa F401
+        import requests  # noqa F401
+    finally:
+        for env in injected:
+            env.deactivate()
+
+
+def test_envs_inject_invalid():
+    envs = [
+        {"channels": ["conda-forge"], "dependencies": ["humanfriendly =10.0"]},
+        {"channels": ["conda-forge"], "dependencies": ["python =3.8"]},
+    ]
+    with pytest.raises(ValueError):
+        inject_envs(envs)
+
+
+@pytest.fixture
+def env_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    env_path = tmp_path / "envs" / "conda-inject-test_"
+    env_path.mkdir(parents=True)
+    return env_path
+
+
+def test_env_cache_hit(env_cache, monkeypatch):
+    conda_inject._cache_env(conda_inject.Environment(str(env_cache)))
+    # a cache hit must not query the package manager
+    monkeypatch.setattr(conda_inject, "_get_envs", None)
+    env = conda_inject._lookup_env(env_cache.name, conda_inject.PackageManager.CONDA)
+    assert env.path == str(env_cache)
+
+
+def test_env_cache_stale(env_cache, monkeypatch):
+    conda_inject._cache_env(conda_inject.Environment(str(env_cache)))
+    env_cache.rmdir()
+    monkeypatch.setattr(conda_inject, "_get_envs", lambda package_manager: {})
+    env = conda_inject._lookup_env(env_cache.name, conda_inject.PackageManager.CONDA)
+    assert env is None
+
+
+def test_env_cache_remove(env_cache):
+    conda_inject._cache_env(conda_inject.Environment(str(env_cache)))
+    conda_inject._uncache_env(env_cache.name)
+    assert env_cache.name not in conda_inject._read_env_cache()
+
+
+def test_env_cache_without_home(monkeypatch):
+    def no_home():
+        raise RuntimeError("Could not determine home directory.")
+
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
+    monkeypatch.setattr(conda_inject.Path, "home", no_home)
+    assert conda_inject._read_env_cache() == {}
+    conda_inject._cache_env(conda_inject.Environment("/nonexistent"))
+
+
+def test_env_cache_write_failure(env_cache, monkeypatch):
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(conda_inject.os, "replace", fail)
+    conda_inject._cache_env(conda_inject.Environment(str(env_cache)))
+    # the temporary file must not be left behind
+    cache_dir = conda_inject._get_env_cache_path().parent
+    assert not list(cache_dir.glob("*.tmp"))
+
+
+def test_dump_env_roundtrip():
+    env = {
+        "channels": ["conda-forge"],
+        "dependencies": ["humanfriendly =10.0", "a: b #c", "\u00fc", "\U0001f600"],
+    }
+    f = StringIO()
+    conda_inject._dump_env(env, f)
+    assert yaml.safe_load(f.getvalue()) == env
+    # empty keys in env files are loaded as None
+    env = {"channels": None, "dependencies": ["humanfriendly =10.0"]}
+    f = StringIO()
+    conda_inject._dump_env(env, f)
+    assert yaml.safe_load(f.getvalue()) == env
+
+
+def test_overlapping_injections(tmp_path):
+    sys_path, path = list(sys.path), os.environ["PATH"]
+    env = conda_inject.Environment(str(tmp_path))
+    a = conda_inject.InjectedEnvironment(
+        "test", conda_inject.PackageManager.CONDA, env=env
+    ).activate()
+    b = conda_inject.InjectedEnvironment(
+        "test", conda_inject.PackageManager.CONDA, env=env
+    ).activate()
+    assert sys.path.count(a._get_syspath_injection()) == 1
+    a.deactivate()
+    # b is still active, hence both its paths must remain
+    assert b._get_syspath_injection() in sys.path
+    assert b._get_path_injection() in os.environ["PATH"].split(os.pathsep)
+    b.deactivate()
+    assert sys.path == sys_path
+    assert os.environ["PATH"] == path
+
+
+def test_construction_has_no_side_effects(monkeypatch):
+    sys_path, path = list(sys.path), os.environ["PATH"]
+    # construction must neither look up the env nor query the package manager
+    monkeypatch.setattr(conda_inject, "_lookup_env", None)
+    monkeypatch.setattr(conda_inject, "_get_envs", None)
+    conda_inject.InjectedEnvironment("test", conda_inject.PackageManager.CONDA)
+    assert sys.path == sys_path
+    assert os.environ["PATH"] == path
+
+
+def test_injection_with_existing_entries(tmp_path):
+    sys_path, path = list(sys.path), os.environ["PATH"]
+    env = conda_inject.Environment(str(tmp_path))
+    a = conda_inject.InjectedEnvironment(
+        "test", conda_inject.PackageManager.CONDA, env=env
+    ).activate()
+    syspath_entry = a._get_syspath_injection()
+    a.deactivate()
+    # an entry that is already present is neither duplicated nor removed
+    sys.path.append(syspath_entry)
+    a.activate()
+    assert sys.path.count(syspath_entry) == 1
+    a.deactivate()
+    assert sys.path.count(syspath_entry) == 1
+    sys.path.remove(syspath_entry)
+    # an entry removed elsewhere is added again by the next injection
+    a.activate()
+    sys.path.remove(syspath_entry)
+    b = conda_inject.InjectedEnvironment(
+        "test", conda_inject.PackageManager.CONDA, env=env
+    ).activate()
+    assert syspath_entry in sys.path
+    a.deactivate()
+    b.deactivate()
+    assert sys.path == sys_path
+    assert os.environ["PATH"] == path
+
+
+class EnvListStub:
+    """Stand-in for the cached _get_envs, returning one result per cache state."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def __call__(self, package_manager):
+        return self.results[0]
+
+    def cache_clear(self):
+        self.results.pop(0)
+
+
+def test_env_list_stale(env_cache, monkeypatch):
+    env_list = EnvListStub(
+        {env_cache.name: conda_inject.Environment(str(env_cache))}, {}
+    )
+    monkeypatch.setattr(conda_inject, "_get_envs", env_list)
+    env_cache.rmdir()
+    # the outdated list entry must be re-queried instead of being injected
+    env = conda_inject._lookup_env(env_cache.name, conda_inject.PackageManager.CONDA)
+    assert env is None
+    assert env_list.results == [{}]
+
+
+@pytest.mark.parametrize(
+    "available,expected",
+    [
+        ({"micromamba", "mamba", "conda"}, conda_inject.PackageManager.MICROMAMBA),
+        ({"mamba", "conda"}, conda_inject.PackageManager.MAMBA),
+        ({"conda"}, conda_inject.PackageManager.CONDA),
+        (set(), conda_inject.PackageManager.MAMBA),
+    ],
+)
+def test_detect_fastest_package_manager(available, expected, monkeypatch):
+    monkeypatch.setattr(
+        conda_inject.shutil,
+        "which",
+        lambda cmd: f"/usr/bin/{cmd}" if cmd in available else None,
+    )
+    conda_inject._detect_fastest_package_manager.cache_clear()
+    try:
+        assert conda_inject._detect_fastest_package_manager() == expected
+    finally:
+        conda_inject._detect_fastest_package_manager.cache_clear()